@@ -4,112 +4,437 @@
 # Placeholders for moderation and immersive features
 # Uses discord.py for Python implementation
 # Modular structure with cogs for easy extension
-# Database: SQLite for user XP and clearance levels
+# Database: SQLite (via aiosqlite) for user XP and clearance levels
 # Assumptions:
 # - Role names match exactly as provided (e.g., "CL-0: Recruit")
 # - Channel names match exactly (e.g., "#welcome", but use channel.name == 'welcome')
 # - Bot token stored in environment variable or .env file (not included here)
 # - Permissions for channels are set via Discord role overrides (bot only manages role assignments)
-# - XP system: Simple +1 XP per message, thresholds increase exponentially (customizable)
-# - Verification: Reaction to a specific message in #verification channel
+# - XP system: Simple +1 XP per message (at most once per XP_COOLDOWN seconds), thresholds increase exponentially (customizable)
+# - Verification: Button on a specific message in #verification channel (posted once, ID kept in bot_state)
 
 import discord
-from discord.ext import commands
-import sqlite3
+from discord.ext import commands, tasks
+import aiosqlite
+from cachetools import LRUCache
 import os
+import collections
+import bisect
+import time
 import asyncio
+import logging
 from dotenv import load_dotenv  # Optional: For loading .env file
 
 # Load environment variables (e.g., bot token)
 load_dotenv()
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 
+log = logging.getLogger(__name__)
+
 # Bot setup
 intents = discord.Intents.default()
 intents.members = True  # Needed for on_member_join
 intents.message_content = True  # Needed for on_message XP
-bot = commands.Bot(command_prefix='!', intents=intents, application_id=YOUR_APP_ID_HERE)  # Replace with your bot's app ID for slash commands
+class SolarisBot(commands.Bot):
+    async def setup_hook(self):
+        # Run setup inside the bot's own event loop so the aiosqlite connection is bound to it
+        await setup_bot()
+
+    async def close(self):
+        # Bot.close removes the cogs first (LevelingCog writes its last XP batch on unload),
+        # so the DB is only closed once nothing else will use it
+        await super().close()
+        await close_db()
+
+bot = SolarisBot(
+    command_prefix='!',
+    intents=intents,
+    application_id=YOUR_APP_ID_HERE,  # Replace with your bot's app ID for slash commands
+    # Skip startup work the bot doesn't use: handlers only touch the member attached to the
+    # event itself, and nothing reads cached messages since verification moved to a button
+    chunk_guilds_at_startup=False,
+    member_cache_flags=discord.MemberCacheFlags.none(),
+    max_messages=None,
+)
 
-# Database setup
+# Database setup (connection is opened in setup_bot so queries run off the event loop)
 DB_FILE = 'solaris.db'
-conn = sqlite3.connect(DB_FILE)
-cursor = conn.cursor()
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        xp INTEGER DEFAULT 0,
-        clearance_level INTEGER DEFAULT 0
-    )
-''')
-conn.commit()
+db = None
+# Serializes writes and transaction control (commit/savepoints) on the shared connection, so a
+# commit can never land in the middle of another coroutine's multi-statement write
+db_lock = asyncio.Lock()
+
+async def init_db():
+    global db
+    db = await aiosqlite.connect(DB_FILE)
+    # WAL lets readers proceed during writes; NORMAL sync avoids an fsync per commit
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    # ~20 MB page cache and 256 MB mmap keep a small-to-medium guild's table memory-resident
+    await db.execute('PRAGMA cache_size=-20000')
+    await db.execute('PRAGMA mmap_size=268435456')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            xp INTEGER DEFAULT 0,
+            clearance_level INTEGER DEFAULT 0,
+            verified INTEGER DEFAULT 0
+        )
+    ''')
+    # Databases created before the verified column existed: add it, treating anyone already at CL-1+ as verified
+    async with db.execute('PRAGMA table_info(users)') as cursor:
+        columns = [row[1] async for row in cursor]
+    if 'verified' not in columns:
+        await db.execute('ALTER TABLE users ADD COLUMN verified INTEGER DEFAULT 0')
+        await db.execute('UPDATE users SET verified = 1 WHERE clearance_level >= 1')
+    # Small key/value store for bot state that must survive restarts
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # No query orders by XP, so an XP index would only slow down every XP write; drop one left
+    # by an earlier version
+    await db.execute('DROP INDEX IF EXISTS idx_users_xp')
+    await db.commit()
+    await db.execute('ANALYZE')
+    commit_db.start()
+
+# User writes are left uncommitted so bursts share one fsync; this loop commits them.
+# It lives in the DB layer so saving joins/verifications doesn't depend on any cog.
+@tasks.loop(seconds=10)
+async def commit_db():
+    async with db_lock:
+        await commit_locked()
+
+async def commit_locked():
+    # Caller must hold db_lock
+    if not db.in_transaction:
+        return
+    try:
+        await db.commit()
+    except Exception:
+        # The transaction stays open, so the next commit simply retries
+        log.exception('DB commit failed; retrying on the next commit')
+
+async def close_db():
+    global db
+    if db is None:
+        return
+    commit_db.cancel()
+    async with db_lock:
+        if db.in_transaction:
+            await db.commit()
+        await db.close()
+        db = None
 
 # Clearance levels and role names
-CLEARANCE_ROLES = {
-    0: 'CL-0: Recruit',
-    1: 'CL-1: Initiate',
-    2: 'CL-2: Asset',
-    3: 'CL-3: Agent',
-    4: 'CL-4: Field Agent',
-    5: 'CL-5: Senior Agent',
-    6: 'CL-6: Special Operative',
-    7: 'CL-7: Handler',
-    8: 'CL-8: Intelligence Officer',
-    9: 'CL-9: Shadow Commander',
-    10: 'CL-10: Control'
-}
+CLEARANCE_ROLE_NAMES = (  # Index is the clearance level
+    'CL-0: Recruit',
+    'CL-1: Initiate',
+    'CL-2: Asset',
+    'CL-3: Agent',
+    'CL-4: Field Agent',
+    'CL-5: Senior Agent',
+    'CL-6: Special Operative',
+    'CL-7: Handler',
+    'CL-8: Intelligence Officer',
+    'CL-9: Shadow Commander',
+    'CL-10: Control',
+)
+ROLE_NAME_TO_LEVEL = {name: level for level, name in enumerate(CLEARANCE_ROLE_NAMES)}
+CLEARANCE_ROLE_NAME_SET = set(CLEARANCE_ROLE_NAMES)
 
 # XP thresholds for promotions (example: exponential growth, adjust as needed)
-XP_THRESHOLDS = [0, 100, 300, 600, 1000, 1500, 2100, 2800, 3600, 4500, 5500]  # Index corresponds to next level
+XP_THRESHOLDS = (0, 100, 300, 600, 1000, 1500, 2100, 2800, 3600, 4500, 5500)  # Index corresponds to next level
+# XP needed to leave each level; CL-10 gets an unreachable sentinel so no bounds check is needed
+NEXT_THRESHOLD = XP_THRESHOLDS[1:] + (1 << 62,)
+
+# Minimum seconds between XP gains for the same user (messages in between still process commands)
+XP_COOLDOWN = 60
+
+# Write-through cache of user_id -> [xp, clearance_level] (mutable lists so increments happen in place).
+# Bounded so large guilds don't grow it without limit; XP deltas are flushed to the DB in batches.
+USER_CACHE = LRUCache(maxsize=50_000)
+# user_id -> XP gained but not yet written to the DB (drained by LevelingCog.flush_xp)
+PENDING_XP = collections.defaultdict(int)
+
+# Cog that keeps per-guild name lookups for roles and text channels,
+# so promotions don't linearly scan guild.roles / guild.text_channels on every event
+class RoleCache(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.role_by_name = {}  # guild_id -> {role name: Role}
+        self.channel_by_name = {}  # guild_id -> {channel name: TextChannel}
+
+    def refresh_roles(self, guild):
+        self.role_by_name[guild.id] = {role.name: role for role in guild.roles}
+
+    def refresh_channels(self, guild):
+        self.channel_by_name[guild.id] = {channel.name: channel for channel in guild.text_channels}
+
+    def get_role(self, guild, name):
+        if guild.id not in self.role_by_name:
+            self.refresh_roles(guild)
+        return self.role_by_name[guild.id].get(name)
+
+    def get_channel(self, guild, name):
+        if guild.id not in self.channel_by_name:
+            self.refresh_channels(guild)
+        return self.channel_by_name[guild.id].get(name)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for guild in self.bot.guilds:
+            self.refresh_roles(guild)
+            self.refresh_channels(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.role_by_name.pop(guild.id, None)
+        self.channel_by_name.pop(guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        self.refresh_roles(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self.refresh_roles(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        self.refresh_roles(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        self.refresh_channels(channel.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.refresh_channels(channel.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        self.refresh_channels(after.guild)
+
+role_cache = RoleCache(bot)
 
 # Helper functions
-def get_user_data(user_id):
-    cursor.execute('SELECT xp, clearance_level FROM users WHERE user_id = ?', (user_id,))
-    return cursor.fetchone() or (0, 0)
-
-def update_user_data(user_id, xp, level):
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, xp, clearance_level)
-        VALUES (?, ?, ?)
-    ''', (user_id, xp, level))
-    conn.commit()
-
-async def promote_user(member, new_level, guild):
-    # Remove lower clearance roles
-    for level in range(0, new_level):
-        role_name = CLEARANCE_ROLES.get(level)
-        if role_name:
-            role = discord.utils.get(guild.roles, name=role_name)
-            if role and role in member.roles:
-                await member.remove_roles(role)
+# User writes hold db_lock and are left uncommitted; commit_db saves them in the next periodic commit
+async def get_user_data(user_id):
+    stats = USER_CACHE.get(user_id)
+    if stats is None:
+        # Under db_lock so an XP flush can't be half-way between draining PENDING_XP and writing
+        async with db_lock:
+            async with db.execute('SELECT xp, clearance_level FROM users WHERE user_id = ?', (user_id,)) as cursor:
+                xp, level = await cursor.fetchone() or (0, 0)
+            # The DB row lags behind by any XP still buffered (e.g. the entry was evicted before a flush)
+            stats = USER_CACHE[user_id] = [xp + PENDING_XP.get(user_id, 0), level]
+    return tuple(stats)
+
+async def update_user_data(user_id, xp, level):
+    async with db_lock:
+        await db.execute('''
+            INSERT INTO users (user_id, xp, clearance_level)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                xp = excluded.xp, clearance_level = excluded.clearance_level, verified = 0
+        ''', (user_id, xp, level))
+    USER_CACHE[user_id] = [xp, level]
+
+async def add_user_xp(user_id, amount):
+    # Increment in SQL and read the result back in the same statement (no prior SELECT).
+    # The returned XP includes any still buffered in PENDING_XP, read under the same lock.
+    async with db_lock:
+        async with db.execute('''
+            INSERT INTO users (user_id, xp, clearance_level)
+            VALUES (?, ?, 0)
+            ON CONFLICT(user_id) DO UPDATE SET xp = xp + excluded.xp
+            RETURNING xp, clearance_level
+        ''', (user_id, amount)) as cursor:
+            xp, level = await cursor.fetchone()
+        return xp + PENDING_XP.get(user_id, 0), level
+
+async def raise_clearance_level(user_id, level):
+    # Only touches clearance_level so buffered XP deltas are not overwritten.
+    # Returns (xp, level) if the level was raised, None if the user was already at or above it.
+    async with db_lock:
+        async with db.execute('''
+            INSERT INTO users (user_id, xp, clearance_level)
+            VALUES (?, 0, ?)
+            ON CONFLICT(user_id) DO UPDATE SET clearance_level = excluded.clearance_level
+            WHERE clearance_level < excluded.clearance_level
+            RETURNING xp, clearance_level
+        ''', (user_id, level)) as cursor:
+            row = await cursor.fetchone()
+    if row and user_id in USER_CACHE:
+        USER_CACHE[user_id][1] = level
+    return row
+
+async def verify_user(user_id):
+    # Records the verification (the CL-1 floor !recalibrate keeps), then raises CL-0 users to CL-1.
+    # Returns (xp, level) if the level was raised, None if the user was already at or above CL-1.
+    async with db_lock:
+        await db.execute('''
+            INSERT INTO users (user_id, xp, clearance_level, verified)
+            VALUES (?, 0, 0, 1)
+            ON CONFLICT(user_id) DO UPDATE SET verified = 1
+        ''', (user_id,))
+    return await raise_clearance_level(user_id, 1)
+
+async def get_bot_state(key):
+    async with db.execute('SELECT value FROM bot_state WHERE key = ?', (key,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def set_bot_state(key, value):
+    async with db_lock:
+        await db.execute('''
+            INSERT INTO bot_state (key, value)
+            VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (key, value))
+        await commit_locked()
+
+async def delete_bot_state(key):
+    async with db_lock:
+        await db.execute('DELETE FROM bot_state WHERE key = ?', (key,))
+        await commit_locked()
+
+background_tasks = set()  # Strong references so pending fire-and-forget tasks aren't garbage collected
+
+def fire_and_forget(coro):
+    # Schedule coro without awaiting it; failures are logged instead of disappearing
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(on_background_task_done)
+
+def on_background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error('Background task failed', exc_info=task.exception())
+
+def compute_levels(xps):
+    # Clearance level earned by each XP value (bulk form of the check in on_message)
+    return [min(10, bisect.bisect_right(XP_THRESHOLDS, xp) - 1) for xp in xps]
+
+async def promote_user(member, new_level, guild, announce=True):
+    new_role_name = CLEARANCE_ROLE_NAMES[new_level]
+    new_role = role_cache.get_role(guild, new_role_name)
+    
+    # Only the clearance roles the member actually holds (other than the new one) need removing
+    stale_roles = [
+        role for role in member.roles
+        if role.name in CLEARANCE_ROLE_NAME_SET and ROLE_NAME_TO_LEVEL[role.name] != new_level
+    ]
+    needs_new_role = new_role is not None and new_role not in member.roles
     
-    # Add new role
-    new_role_name = CLEARANCE_ROLES.get(new_level)
-    if new_role_name:
-        new_role = discord.utils.get(guild.roles, name=new_role_name)
-        if new_role:
-            await member.add_roles(new_role)
+    # Apply removals and the addition in a single PATCH, or skip it if nothing changes
+    # (@everyone is implicit and can't be sent back in the role list)
+    if stale_roles or needs_new_role:
+        roles = [role for role in member.roles if role not in stale_roles and not role.is_default()]
+        if needs_new_role:
+            roles.append(new_role)
+        await member.edit(roles=roles, reason='CL promotion')
     
-    # Announce promotion
-    announcements_channel = discord.utils.get(guild.text_channels, name='announcements')
-    if announcements_channel:
-        await announcements_channel.send(f"**Promotion Alert:** {member.mention} has been elevated to {new_role_name}!")
+    # Announce promotion (off the critical path so the caller isn't held up by the REST call)
+    announcements_channel = role_cache.get_channel(guild, 'announcements')
+    if announce and announcements_channel:
+        fire_and_forget(announcements_channel.send(f"**Promotion Alert:** {member.mention} has been elevated to {new_role_name}!"))
+
+# Persistent "Verify" button; Discord routes clicks straight here, so no global reaction listener is needed
+class VerifyView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)  # Required for the view to outlive restarts
+
+    @discord.ui.button(label='Verify', style=discord.ButtonStyle.success, custom_id='solaris:verify')
+    async def verify(self, interaction: discord.Interaction, button: discord.ui.Button):
+        member = interaction.user
+        if interaction.guild is None or member.bot:
+            return await interaction.response.defer()
+        
+        # Promote to CL-1 if currently CL-0 (defer first: the role edit can outlast the 3s response window)
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        raised = await verify_user(member.id)
+        async with db_lock:
+            await commit_locked()  # Save the grant before confirming it
+        if raised:
+            await promote_user(member, 1, interaction.guild)
+            await interaction.followup.send("Clearance granted: CL-1: Initiate.", ephemeral=True)
+        else:
+            await interaction.followup.send("You are already verified.", ephemeral=True)
 
 # Cog for Onboarding and Verification
 class OnboardingCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.verification_message_id = None  # To store the ID of the verification message
+        self.verification_checked = False  # on_ready also fires on reconnects; check once per startup
+        self.legacy_verification_message_id = None  # Old reaction-based message, removed on ready
+
+    async def cog_load(self):
+        # Re-register the button handler for messages posted before a restart
+        self.bot.add_view(VerifyView())
+        # Reuse the verification message posted before a restart instead of posting another
+        value = await get_bot_state('verif_button_msg_id')
+        if value:
+            self.verification_message_id = int(value)
+        value = await get_bot_state('verif_msg_id')
+        if value:
+            self.legacy_verification_message_id = int(value)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Post the verification message up front (instead of on the first member join),
+        # and repost it if the stored one has been deleted
+        if self.verification_checked:
+            return
+        for guild in self.bot.guilds:
+            verification_channel = role_cache.get_channel(guild, 'verification')
+            if not verification_channel:
+                continue
+            try:
+                if self.legacy_verification_message_id:
+                    # The ✅ reaction message from before the button no longer does anything
+                    try:
+                        await verification_channel.get_partial_message(self.legacy_verification_message_id).delete()
+                    except discord.NotFound:
+                        pass  # Already gone
+                    await delete_bot_state('verif_msg_id')
+                    self.legacy_verification_message_id = None
+                if self.verification_message_id:
+                    try:
+                        await verification_channel.fetch_message(self.verification_message_id)
+                        self.verification_checked = True  # Still there
+                        return
+                    except discord.NotFound:
+                        pass  # Deleted: post a replacement below
+                msg = await verification_channel.send(
+                    "Press **Verify** to gain CL-1: Initiate clearance.",
+                    view=VerifyView(),
+                )
+            except discord.HTTPException:
+                # e.g. missing Read Message History / Send Messages; the flag stays unset so the
+                # next on_ready (reconnect) tries again
+                log.exception('Could not check or post the verification message in %s', guild)
+                return
+            self.verification_message_id = msg.id
+            await set_bot_state('verif_button_msg_id', str(msg.id))
+            self.verification_checked = True
+            return
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
         # Assign CL-0: Recruit role
         guild = member.guild
-        recruit_role = discord.utils.get(guild.roles, name=CLEARANCE_ROLES[0])
+        recruit_role = role_cache.get_role(guild, CLEARANCE_ROLE_NAMES[0])
         if recruit_role:
             await member.add_roles(recruit_role)
         
         # Update DB
-        update_user_data(member.id, 0, 0)
+        await update_user_data(member.id, 0, 0)
         
         # DM welcome message with Directive 01
         welcome_msg = (
@@ -121,59 +446,137 @@ class OnboardingCog(commands.Cog):
             await member.send(welcome_msg)
         except discord.Forbidden:
             pass  # User has DMs disabled
-        
-        # Send verification message if not already sent
-        verification_channel = discord.utils.get(guild.text_channels, name='verification')
-        if verification_channel and not self.verification_message_id:
-            msg = await verification_channel.send(
-                "React with ✅ to verify and gain CL-1: Initiate clearance."
-            )
-            await msg.add_reaction('✅')
-            self.verification_message_id = msg.id
-
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload):
-        if payload.message_id != self.verification_message_id:
-            return
-        if str(payload.emoji) != '✅':
-            return
-        
-        guild = self.bot.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        if member and member.bot:
-            return
-        
-        # Promote to CL-1 if currently CL-0
-        _, current_level = get_user_data(payload.user_id)
-        if current_level == 0:
-            update_user_data(payload.user_id, 0, 1)
-            await promote_user(member, 1, guild)
 
 # Cog for Leveling and Promotions
 class LevelingCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.cooldown = {}  # user_id -> time.monotonic() of their last XP gain
+        self.flush_xp.start()
+        self.evict_cooldowns.start()
+
+    async def cog_unload(self):
+        self.flush_xp.cancel()
+        self.evict_cooldowns.cancel()
+        # Write out whatever is still buffered; the DB is closed only after cogs are removed
+        await self.flush_xp()
+
+    @tasks.loop(hours=1)
+    async def evict_cooldowns(self):
+        # Drop expired entries so the dict only holds recently active users
+        cutoff = time.monotonic() - XP_COOLDOWN
+        self.cooldown = {user_id: last for user_id, last in self.cooldown.items() if last > cutoff}
+
+    @tasks.loop(seconds=10)
+    async def flush_xp(self):
+        async with db_lock:
+            # Drain the buffer only once the lock is held, so cache reloads (which also take it)
+            # never see the batch missing from both the buffer and the DB
+            pending = dict(PENDING_XP)
+            PENDING_XP.clear()
+            if not pending:
+                return
+            try:
+                # Every write holds db_lock, so the open transaction only contains finished writes;
+                # a savepoint lets a failed batch be undone without discarding them
+                if not db.in_transaction:
+                    await db.execute('BEGIN')
+                await db.execute('SAVEPOINT flush_xp')
+                try:
+                    await db.executemany('''
+                        INSERT INTO users (user_id, xp, clearance_level)
+                        VALUES (?, ?, 0)
+                        ON CONFLICT(user_id) DO UPDATE SET xp = xp + excluded.xp
+                    ''', list(pending.items()))
+                except Exception:
+                    await db.execute('ROLLBACK TO flush_xp')
+                    raise
+                finally:
+                    await db.execute('RELEASE flush_xp')
+            except Exception:
+                # Keep the loop alive (tasks.loop only retries network errors) and put the batch
+                # back so it is written on the next tick instead of lost
+                log.exception('XP flush failed; retrying next tick')
+                for user_id, xp in pending.items():
+                    PENDING_XP[user_id] += xp
+                return
+            # The batch is now part of the transaction; if this commit fails, commit_db retries it
+            await commit_locked()
+
+    @commands.command(name='recalibrate')
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def recalibrate(self, ctx):
+        # Re-apply XP_THRESHOLDS to every stored user (e.g. after editing them) and sync their roles.
+        # Levels can go up or down; verified members never drop below CL-1.
+        await self.flush_xp()  # Takes db_lock itself, so it must run before the block below
+        async with db_lock:
+            user_ids, xps, levels, floors = [], [], [], []
+            async with db.execute('SELECT user_id, xp, clearance_level, verified FROM users') as cursor:
+                async for user_id, xp, level, verified in cursor:
+                    user_ids.append(user_id)
+                    xps.append(xp)
+                    levels.append(level)
+                    floors.append(1 if verified else 0)
+            updates, raised = [], 0
+            for user_id, level, floor, computed in zip(user_ids, levels, floors, compute_levels(xps)):
+                new_level = max(computed, floor)
+                if new_level != level:
+                    updates.append((new_level, user_id))
+                    raised += new_level > level
+            await db.executemany('UPDATE users SET clearance_level = ? WHERE user_id = ?', updates)
+            await commit_locked()
+            for new_level, user_id in updates:
+                if user_id in USER_CACHE:
+                    USER_CACHE[user_id][1] = new_level
+        roles_failed = 0
+        for new_level, user_id in updates:
+            # Members aren't cached (MemberCacheFlags.none()), so fetch each one being changed
+            try:
+                member = await ctx.guild.fetch_member(user_id)
+            except discord.NotFound:
+                continue  # No longer in the server; their role is set again if they rejoin and level up
+            try:
+                await promote_user(member, new_level, ctx.guild, announce=False)
+            except discord.HTTPException:
+                log.exception('Recalibration could not update roles for %s', user_id)
+                roles_failed += 1
+        summary = f"Recalibration complete: {raised} clearance level(s) raised, {len(updates) - raised} lowered."
+        if roles_failed:
+            summary += f" Role update failed for {roles_failed} member(s); see logs."
+        await ctx.send(summary)
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author.bot:
+        # No XP for bots or DMs. Commands are dispatched by the default Bot.on_message,
+        # so this listener never calls process_commands itself.
+        if message.guild is None or message.author.bot:
             return
         
-        # Add XP (simple: +1 per message, adjust for activity)
-        xp, level = get_user_data(message.author.id)
-        xp += 1
-        update_user_data(message.author.id, xp, level)
+        # Skip XP (and all DB work) while the author is on cooldown
+        user_id = message.author.id
+        now = time.monotonic()
+        if now - self.cooldown.get(user_id, float('-inf')) < XP_COOLDOWN:
+            return
+        self.cooldown[user_id] = now
         
-        # Check for promotion
-        if level < 10:
-            next_threshold = XP_THRESHOLDS[level + 1]
-            if xp >= next_threshold:
-                new_level = level + 1
-                update_user_data(message.author.id, xp, new_level)
-                await promote_user(message.author, new_level, message.guild)
+        # Add XP (simple: +1 per message, adjust for activity)
+        stats = USER_CACHE.get(user_id)
+        if stats is None:
+            # Not cached: increment and read back (plus any XP still buffered, in case
+            # their entry was evicted before a flush) in a single UPSERT
+            stats = USER_CACHE[user_id] = list(await add_user_xp(user_id, 1))
+        else:
+            stats[0] += 1
+            PENDING_XP[user_id] += 1
+        xp, level = stats
         
-        # Process commands if any
-        await self.bot.process_commands(message)
+        # Check for promotion (jumps straight to the final rank if several thresholds were crossed)
+        if xp >= NEXT_THRESHOLD[level]:
+            new_level = min(10, bisect.bisect_right(XP_THRESHOLDS, xp) - 1)
+            stats[1] = new_level
+            await raise_clearance_level(user_id, new_level)
+            await promote_user(message.author, new_level, message.guild)
 
 # Cog for Commands (e.g., /dossier)
 class CommandsCog(commands.Cog):
@@ -186,8 +589,9 @@ class CommandsCog(commands.Cog):
         if user is None:
             user = interaction.user
         
-        xp, level = get_user_data(user.id)
-        role_name = CLEARANCE_ROLES.get(level, 'Unknown')
+        # Served from USER_CACHE (includes XP not yet flushed); only a cache miss reads SQLite
+        xp, level = await get_user_data(user.id)
+        role_name = CLEARANCE_ROLE_NAMES[level] if 0 <= level < len(CLEARANCE_ROLE_NAMES) else 'Unknown'
         
         embed = discord.Embed(title=f"Dossier: {user.display_name}", color=discord.Color.dark_blue())
         embed.add_field(name="Clearance Level", value=f"CL-{level}", inline=True)
@@ -239,13 +643,14 @@ async def on_ready():
 
 # Add cogs
 async def setup_bot():
+    await init_db()
+    await bot.add_cog(role_cache)
     await bot.add_cog(OnboardingCog(bot))
     await bot.add_cog(LevelingCog(bot))
     await bot.add_cog(CommandsCog(bot))
     await bot.add_cog(ModerationCog(bot))
     await bot.add_cog(ImmersiveCog(bot))
 
-asyncio.run(setup_bot())
 bot.run(TOKEN)
 
 # To extend: